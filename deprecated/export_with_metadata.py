@@ -11,17 +11,19 @@ It should be noted that this script *does not* use the web API to
 Zotero; rather, it uses SQLite queries to the *local* Zotero
 database. Therefore, the user is encouraged to sync with zotero.org
 prior to running this script. Also, the Zotero desktop client should be
-closed while this script runs. Failing to do so will trigger the
-following error message
-
-    sqlite3.OperationalError: database is locked
+closed while this script runs. The database is opened as immutable
+(neither locks nor changes are checked): reading it while the desktop
+client writes to it might return inconsistent results.
 
 The script first tries to find the user's Zotero profile (a file that is
 called prefs.js). In case of failure, it is possible to specify the
 relevent preferences from the command line (see the --data and --base
 options).
 """
+import concurrent.futures
+import itertools
 import os.path
+import re
 import sqlite3
 import sys
 
@@ -34,12 +36,15 @@ PATH_HELP = ('The path to the attachment file. Both linked and stored '
              'with "attachments:", while path to the latter must be a '
              'true file path. The specified path is passed to a SQLite '
              'LIKE clause. As such, wildcards "_" (single character) '
-             'and "%%" (multiple characters) are accepted.')
+             'and "%%" (multiple characters) are accepted. Several '
+             'paths can be specified, in which case all attachments '
+             'are exported in one go.')
 OUTPUT_HELP = ('The path to the cloned PDF (with metadata). If not '
                'provided, the cloned PDF file will be stored in the '
                'current directory, under the name '
                '"input-with_metadata.pdf", where "input.pdf" is the '
-               'name of the input file.')
+               'name of the input file. This option is only allowed '
+               'if a single path is specified.')
 DATA_HELP = ('Full path to the Zotero database. When this option is '
              'set, the Zotero preferences files prefs.js is not '
              'loaded.')
@@ -49,81 +54,94 @@ BASE_HELP = ('The path to the root directory of linked attachments. '
              'if --data is not specified. It is required to export '
              'linked attachments when the --data option is specified.')
 
-PDF_EXTENSION = '.pdf'
 WITH_METADATA = '-with_metadata'
 
 # Preference keys (to be found in the prefs.js file)
 BASE_ATTACHMENT_PATH_KEY = 'extensions.zotero.baseAttachmentPath'
 DATA_DIR_KEY = 'extensions.zotero.dataDir'
 
-
-def get_field_ID(field_name, cursor):
-    """Return the ID for the specified name in the Zotero table fields.
+# The connection to the Zotero database is short-lived and read-only:
+# pages are memory-mapped (256MB) rather than read, the page cache is
+# enlarged (64MB) and temporary tables are kept in memory.
+SQLITE_PRAGMAS = ('mmap_size=268435456',
+                  'cache_size=-65536',
+                  'temp_store=MEMORY',
+                  'query_only=ON')
+
+# SQL queries. The sqlite3 module keeps a cache of prepared statements,
+# keyed by the text of the query: these statements are parsed only
+# once per connection, however many items are processed.
+METADATA_QUERY = ('SELECT 0, 0, itemDataValues.value '
+                  'FROM itemData INNER JOIN itemDataValues '
+                  'ON itemData.valueID=itemDataValues.valueID '
+                  'INNER JOIN fields ON itemData.fieldID=fields.fieldID '
+                  "WHERE itemData.itemID=?1 AND fields.fieldName='title' "
+                  'UNION ALL '
+                  'SELECT 1, itemCreators.orderIndex, creators.lastName '
+                  'FROM itemCreators INNER JOIN creators '
+                  'ON itemCreators.creatorID=creators.creatorID '
+                  'WHERE itemCreators.itemID=?1 '
+                  'ORDER BY 1, 2')
+
+ATTACHMENTS_QUERY = ('SELECT parentItemID, path FROM itemAttachments '
+                     'WHERE path LIKE ?')
+
+# Same as above, for patterns without wildcards. Like LIKE, the NOCASE
+# collation ignores the case of ASCII characters.
+ATTACHMENT_QUERY = ('SELECT parentItemID, path FROM itemAttachments '
+                    'WHERE path = ? COLLATE NOCASE')
+
+# All attachments, to be matched in memory against several patterns
+ALL_ATTACHMENTS_QUERY = ('SELECT parentItemID, path FROM itemAttachments '
+                         'WHERE path IS NOT NULL')
+
+
+def get_metadata(item_ID, cursor):
+    """Return the authors and title of the item in the Zotero database.
+
+    Both are retrieved through a single query, which returns the title
+    first, then the last names of the authors in order. The authors are
+    returned as a single string of coma separated last names.
 
     Args:
-        field_name: The value of the column fieldName.
+        item_ID: The value of the column itemID in the Zotero tables
+            itemData and itemCreators.
         cursor: The Cursor object through which the SQLite queries are
             sent to the Zotero database.
 
     Returns:
-        The value of the column fieldID that matches field_name in the
-        Zotero table fields.
+        An (authors, title) pair.
     """
-    query = 'SELECT fieldID FROM fields WHERE fields.fieldName=?'
-    cursor.execute(query, (field_name,))
-    field_ID, = cursor.fetchone()
-    return field_ID
-
-
-def get_title(item_ID, cursor, field_ID=None):
-    """Return the title of the item in the Zotero database.
-
-    Args:
-        item_ID: The value of the column itemID in the Zotero table
-            itemData
-        cursor: The Cursor object through which the SQLite queries are
-            sent to the Zotero database.
-        field_ID: In the fields table, the fieldID column value of the
-            entry whose fieldValue column value is: title. If None, the
-            function first queries for it.
-
-    Returns:
-        The title of the item.
-    """
-    if field_ID is None:
-        field_ID = get_field_ID('title', cursor)
-
-    query = ('SELECT itemDataValues.value '
-             'FROM itemData INNER JOIN itemDataValues '
-             'ON itemData.valueID=itemDataValues.valueID '
-             'WHERE itemData.itemID=? AND itemData.fieldID=?')
-    cursor.execute(query, (item_ID, field_ID))
-    title, = cursor.fetchone()
-
-    return title
+    cursor.execute(METADATA_QUERY, (item_ID,))
+    title = None
+    authors = []
+    for kind, _, value in cursor:
+        if kind == 0:
+            title = value
+        else:
+            authors.append(value)
 
+    if len(authors) <= 1:
+        return ''.join(authors), title
+    else:
+        others = itertools.islice(authors, len(authors)-1)
+        return '{} and {}'.format(', '.join(others), authors[-1]), title
 
-def get_authors(itemID, cursor):
-    """Return the authors of the item in the Zotero database.
 
-    The authors are returned as a single string of coma separated last
-    names.
+def like_to_regex(pattern):
+    """Return the regular expression equivalent to the LIKE pattern.
 
+    Like the SQLite LIKE operator, the regular expression ignores the
+    case of ASCII characters only.
     """
-    query = ('SELECT itemCreators.orderIndex, creators.lastName '
-             'FROM itemCreators INNER JOIN creators '
-             'ON itemCreators.creatorID=creators.creatorID '
-             'WHERE itemCreators.itemID=?')
-    cursor.execute(query, (itemID,))
-    authors = [lastName for _, lastName in sorted(cursor, key=lambda t: t[0])]
-
-    if len(authors) == 1:
-        return authors[0]
-    else:
-        return ', '.join(authors[:-1])+' and '+authors[-1]
+    tokens = re.split('([%_])', pattern)
+    translation = {'%': '.*', '_': '.'}
+    return re.compile(''.join(translation.get(token) or re.escape(token)
+                              for token in tokens),
+                      re.ASCII | re.IGNORECASE | re.DOTALL)
 
 
-def find_attachments(pattern, cursor):
+def find_attachments(pattern, cursor, attachments=None):
     """Return a list of attachments that match the specified pattern.
 
     Args:
@@ -131,17 +149,28 @@ def find_attachments(pattern, cursor):
             passed to a LIKE clause).
         cursor: The Cursor object through which the SQLite queries are
             sent to the Zotero database.
+        attachments: If not None, the list of all (parentItemID, path)
+            pairs (see ALL_ATTACHMENTS_QUERY), which are then matched
+            in memory: when looking up several patterns, the Zotero
+            table itemAttachments is thus scanned only once.
 
     Returns:
         A list of (parentItemID, path) pairs that match the specified
         pattern. The returned list is empty if no matches are found.
     """
-    query = 'SELECT parentItemID, path FROM itemAttachments WHERE path LIKE ?'
-    cursor.execute(query, (pattern,))
-    return list(cursor)
+    if attachments is not None:
+        regex = like_to_regex(pattern)
+        return [(item_ID, path) for item_ID, path in attachments
+                if regex.fullmatch(path)]
+    # Testing equality is cheaper than matching a pattern
+    if '%' in pattern or '_' in pattern:
+        cursor.execute(ATTACHMENTS_QUERY, (pattern,))
+    else:
+        cursor.execute(ATTACHMENT_QUERY, (pattern,))
+    return cursor.fetchall()
 
 
-def select_attachment(pattern, cursor):
+def select_attachment(pattern, cursor, attachments=None):
     """Prompt the user for the attachment that matches the pattern.
 
     Args:
@@ -151,7 +180,7 @@ def select_attachment(pattern, cursor):
     Returns:
         A (parentItemID, path) pair, None if no matches were found.
     """
-    attachments = find_attachments(args.path, cursor)
+    attachments = find_attachments(pattern, cursor, attachments)
     num_attachments = len(attachments)
     if num_attachments == 0:
         return None
@@ -166,7 +195,7 @@ def select_attachment(pattern, cursor):
 def setup_argument_parser():
     parser = ArgumentParser(description=__doc__,
                             formatter_class=RawDescriptionHelpFormatter)
-    parser.add_argument('path', help=PATH_HELP)
+    parser.add_argument('path', nargs='+', help=PATH_HELP)
     parser.add_argument('-o', '--output', help=OUTPUT_HELP)
     parser.add_argument('--data', help=DATA_HELP)
     parser.add_argument('--base', help=BASE_HELP)
@@ -179,6 +208,10 @@ def sqlite_ro_connection(path):
     This feature is only available as of Python 3.4.0. See
     https://docs.python.org/3.4/library/sqlite3.html#sqlite3.connect
 
+    The database is assumed not to change while the connection is open
+    (immutable URI parameter), and the connection is further tuned for
+    reading (see SQLITE_PRAGMAS).
+
     Args:
         path: The full path to the database.
 
@@ -188,9 +221,13 @@ def sqlite_ro_connection(path):
     """
     major, minor = sys.version_info[0:2]
     if major >= 3 and minor >= 4:
-        return sqlite3.connect('file:'+path+'?mode=ro', uri=True)
+        connection = sqlite3.connect('file:'+path+'?mode=ro&immutable=1',
+                                     uri=True)
     else:
-        return sqlite3.connect(path)
+        connection = sqlite3.connect(path)
+    for pragma in SQLITE_PRAGMAS:
+        connection.execute('PRAGMA '+pragma)
+    return connection
 
 
 def default_output_name(input_name):
@@ -199,53 +236,95 @@ def default_output_name(input_name):
     This function is invoked when no ``--output`` option is specified
     (see the documentation of this option for further details).
     """
-    tokens = os.path.split(input_name)
-    basename = (tokens[-1][:-len(PDF_EXTENSION)]+WITH_METADATA+PDF_EXTENSION)
-    return os.path.join(os.getcwd(), basename)
+    root, ext = os.path.splitext(os.path.basename(input_name))
+    return os.path.join(os.getcwd(), root+WITH_METADATA+ext)
+
+
+def export_attachment(iname, oname, author, title):
+    """Clone the PDF file iname to oname, setting author and title.
+
+    Appending an incremental update is much cheaper than rewriting the
+    whole file, but is not supported for encrypted or damaged files, nor
+    for files with XMP metadata (which the incremental update would
+    leave stale).
+    """
+    try:
+        pyzottk.pdf.add_metadata_incremental(iname, oname, author, title)
+    except ValueError:
+        pyzottk.pdf.add_metadata(iname, oname, author, title)
 
 
 if __name__ == '__main__':
-    args = setup_argument_parser().parse_args()
+    parser = setup_argument_parser()
+    args = parser.parse_args()
+    if args.output and len(args.path) > 1:
+        parser.error('--output is only allowed with a single path')
 
     if args.data:
         database_path = args.data
+        base_attachment_path = args.base
     else:
         path = pyzottk.prefs.select()
         if path:
             prefs = pyzottk.prefs.parse(path)
             database_path = os.path.join(prefs[DATA_DIR_KEY], 'zotero.sqlite')
+            base_attachment_path = prefs.get(BASE_ATTACHMENT_PATH_KEY)
         else:
             raise RuntimeError('could not locate Zotero preferences')
 
+    # All attachments are looked up through the same connection, which is
+    # closed before the (much longer) export of the PDF files
     connection = sqlite_ro_connection(database_path)
     cursor = connection.cursor()
 
-    out = select_attachment(args.path, cursor)
-    if out:
-        parentItemID, path = out
+    if len(args.path) > 1:
+        attachments = cursor.execute(ALL_ATTACHMENTS_QUERY).fetchall()
     else:
-        raise ValueError('No attachments match the specified pattern!')
-
-    if path.startswith(pyzottk.attachment.PATH_PREFIX):
-        if args.data:
-            if args.base:
-                base_attachment_path = args.base
-            else:
-                raise RuntimeError('Base attachment path must be specified.')
+        attachments = None
+
+    # Several patterns may match the same attachment, and attachments
+    # with the same base name share the same default output name: each
+    # output file must be written by one export only (exports run
+    # concurrently)
+    exports = []
+    inames = {}
+    for pattern in args.path:
+        out = select_attachment(pattern, cursor, attachments)
+        if out:
+            parentItemID, path = out
         else:
-            base_attachment_path = prefs[BASE_ATTACHMENT_PATH_KEY]
-    iname = pyzottk.attachment.full_path(path, base_attachment_path)
-    oname = args.output or default_output_name(iname)
-
-    fieldID = get_field_ID('title', cursor)
+            raise ValueError('No attachments match the specified pattern: '
+                             + pattern)
 
-    with open(iname, 'rb') as istream, open(oname, 'wb') as ostream:
-        pyzottk.pdf.add_metadata(istream, ostream,
-                                 get_authors(parentItemID, cursor),
-                                 get_title(parentItemID, cursor, fieldID))
+        if not path.startswith(pyzottk.attachment.PATH_PREFIX):
+            base = None
+        elif base_attachment_path:
+            base = base_attachment_path
+        else:
+            raise RuntimeError('Base attachment path must be specified.')
+        iname = pyzottk.attachment.full_path(path, base)
+        oname = args.output or default_output_name(iname)
+        if oname in inames:
+            if inames[oname] == iname:
+                continue
+            raise ValueError('Several attachments would be exported to '
+                             + oname)
+        inames[oname] = iname
+        exports.append((iname, oname) + get_metadata(parentItemID, cursor))
 
     connection.close()
 
+    # Exporting PDF files is CPU-bound: several files are exported in
+    # parallel processes
+    if len(exports) == 1:
+        export_attachment(*exports[0])
+    else:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            futures = [executor.submit(export_attachment, *export)
+                       for export in exports]
+            for future in futures:
+                future.result()
+
 # Local Variables:
 # fill-column: 72
 # End:
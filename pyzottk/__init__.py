@@ -1,5 +1,7 @@
 """pyzottk is a module that allows interaction with Zotero libraries.
 """
+import sys
+
 import pyzottk.attachment
 import pyzottk.pdf
 import pyzottk.prefs
@@ -27,17 +29,13 @@ def simple_menu(entries, msg=None):
     entries = list(entries)
     num_entries = len(entries)
     num_digits = len(str(num_entries-1))
-    for index, entry in enumerate(entries):
-        index_str = '[{0}]'.format(index).rjust(num_digits+2)
-        print(index_str+' '+entry)
+    lines = ['[{0:>{1}}] {2}'.format(index, num_digits, entry)
+             for index, entry in enumerate(entries)]
+    sys.stdout.write('\n'.join(lines)+'\n')
 
     err_msg = 'Selection n must be such that: 0 <= n < {}!'.format(num_entries)
     while True:
-        try:
-            selection = int(input(msg or ''))
-            if selection >= 0 and selection < len(entries):
-                break
-        except ValueError:
-            pass
+        selection = input(msg or '').strip()
+        if selection.isdecimal() and int(selection) < num_entries:
+            return int(selection)
         print(err_msg)
-    return selection
@@ -28,15 +28,16 @@ def full_path(path, base_attachment_path):
             attachment. Conversely, base_attachment_path was None for a
             linked attachment.
     """
-    # TODO Allow for base_attachment_path is None
     if path.startswith(PATH_PREFIX):
-        if path is None:
+        if base_attachment_path is None:
             raise ValueError('base_attachment_path should not be None for '
                              'linked attachments')
-        tokens = path[len(PATH_PREFIX):].split('/')
-        return os.path.join(base_attachment_path, *tokens)
+        relative_path = path[len(PATH_PREFIX):]
+        if os.sep != '/':
+            relative_path = relative_path.replace('/', os.sep)
+        return os.path.join(base_attachment_path, relative_path)
     else:
-        if path is not None:
+        if base_attachment_path is not None:
             raise ValueError('base_attachment_path should be None for stored '
                              'attachments')
         return path
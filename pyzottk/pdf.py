@@ -1,47 +1,194 @@
 """Helper functions for the pypdf2 module.
+
+If installed, the pikepdf module (bindings to the qpdf C++ library) is
+used instead of PyPDF2 to add metadata to PDF files.
+
+Both modules are slow to import: they are only imported when first
+needed, so that importing pyzottk remains cheap.
 """
-import itertools
+import codecs
+import functools
+import io
+import mmap
+import os
+import re
+import shutil
+import sys
+
+# Size of the buffer used to copy PDF files (when sendfile is not
+# available)
+COPY_BUFFER_SIZE = 1 << 20
+
+# Maximum size of PDF files that are read in memory at once by
+# add_metadata (larger files are memory-mapped)
+MAX_IN_MEMORY_SIZE = 256 << 20
+
+# Entries of the trailer dictionary that are parsed by read_trailer
+TRAILER_SIZE_RE = re.compile(rb'/Size\s+(\d+)')
+TRAILER_ROOT_RE = re.compile(rb'/Root\s+(\d+\s+\d+\s+R)')
+TRAILER_PREV_RE = re.compile(rb'/Prev\s+(\d+)')
+TRAILER_INFO_RE = re.compile(rb'/Info\s+(\d+\s+\d+\s+R)')
+TRAILER_ID_RE = re.compile(rb'/ID\s*(\[\s*<[0-9A-Fa-f\s]*>\s*'
+                           rb'<[0-9A-Fa-f\s]*>\s*\])')
+
+# White-space characters (see section 7.2.2 of the PDF specification)
+PDF_WHITESPACE = (b'\0', b'\t', b'\n', b'\f', b'\r', b' ')
+
+# Header of an indirect object ("num gen obj")
+OBJECT_HEADER_RE = re.compile(rb'\d+\s+\d+\s+obj\b')
+
+# Entries of the /Info dictionary that are parsed by read_info
+INFO_ENTRY_RE = re.compile(rb'/(Author|Title)\s*([(<])')
 
-import PyPDF2
+# Escape sequences of literal strings (octal codes excepted)
+LITERAL_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b',
+                   b'f': b'\f', b'(': b'(', b')': b')', b'\\': b'\\'}
+
+
+@functools.lru_cache(maxsize=1)
+def import_pikepdf():
+    """Return the pikepdf module, None if it is not installed."""
+    try:
+        import pikepdf
+    except ImportError:
+        return None
+    return pikepdf
 
 
 def is_destination(obj):
     """Return True if obj is an instance of PyPDF2.generic.Destination."""
+    import PyPDF2
     return isinstance(obj, PyPDF2.generic.Destination)
 
 
 def copy_bookmarks(src, dest, outlines=None, parent=None):
     """Copy the bookmarks from src to dest.
 
+    Nested outlines are walked with an explicit stack, so that deeply
+    nested bookmarks do not hit the recursion limit.
+
     Args:
         src (PyPDF2.PdfFileReader): The source.
         dest (PyPDF2.PdfFileWriter): The destination.
         outlines (list of PyPDF2.generic.Destination): The outlines to be
-            copied (for recursive calls). If None, then uses all elements
-            returned by``src.getOutlines()``.
+            copied. If None, then uses all elements returned
+            by``src.getOutlines()``.
         parent (PyPDF2.generic.IndirectObject): The parent bookmark (if
             outlines are nested).
     """
+    import PyPDF2
+    # Looked up once, rather than through is_destination for each outline
+    Destination = PyPDF2.generic.Destination
     if outlines is None:
         outlines = src.getOutlines()
-    for current, next in itertools.zip_longest(outlines, outlines[1:]):
-        if is_destination(current):
-            bookmark = dest.addBookmark(current.title,
-                                        src.getDestinationPageNumber(current),
-                                        parent=parent)
-            if next and not is_destination(next):
-                copy_bookmarks(src, dest, outlines=next, parent=bookmark)
+    stack = [(outlines, parent)]
+    while stack:
+        outlines, parent = stack.pop()
+        num_outlines = len(outlines)
+        for i, current in enumerate(outlines):
+            if isinstance(current, Destination):
+                bookmark = dest.addBookmark(
+                    current.title, src.getDestinationPageNumber(current),
+                    parent=parent)
+                if i+1 < num_outlines:
+                    next = outlines[i+1]
+                    if next and not isinstance(next, Destination):
+                        stack.append((next, bookmark))
+
+
+def has_metadata(path, author, title):
+    """Return True if the PDF file has the specified author and title.
+
+    The trailer and the /Info dictionary of the file are read by hand
+    (see read_trailer and read_info). The whole cross-reference table is
+    parsed by PyPDF2 only if this fails (e.g. cross-reference streams,
+    or text strings that read_info cannot decode). False is returned if
+    the file cannot be read.
+
+    Args:
+        path: The path to the PDF file.
+        author: The expected '/Author' metadata (string).
+        title: The expected '/Title' metadata (string).
+    """
+    try:
+        with open(path, 'rb') as stream:
+            try:
+                prev = find_startxref(stream)
+            except ValueError:
+                return has_metadata_pypdf2(stream, author, title)
+            trailer = read_trailer(stream, prev)
+            if trailer is None:
+                return has_metadata_pypdf2(stream, author, title)
+            if b'/Info' not in trailer:
+                return False
+            info = read_info(stream, trailer, prev)
+            if None in info:
+                # Missing entries cannot be told from unreadable ones
+                return has_metadata_pypdf2(stream, author, title)
+            return info == (author, title)
+    except OSError:
+        return False
+
+
+def has_metadata_pypdf2(stream, author, title):
+    """Return True if the PDF file has the specified author and title.
+
+    This function is a fallback to has_metadata, for the files whose
+    /Info dictionary it could not read.
+    """
+    import PyPDF2
+    try:
+        info = PyPDF2.PdfFileReader(stream).getDocumentInfo()
+        if info is None:
+            return False
+        return (info.getObject().get('/Author') == author and
+                info.getObject().get('/Title') == title)
+    except Exception:
+        # PyPDF2 raises all sorts of exceptions on invalid files
+        return False
 
 
 def add_metadata(istream, ostream, author, title):
     """Add author and title metadata to PDF file.
 
+    If pikepdf is available, the document is saved by qpdf, which does
+    not decode page contents, and both the XMP metadata and the /Info
+    dictionary are updated. Otherwise, all pages and bookmarks are
+    copied to a new document by PyPDF2.
+
+    Paths should be preferred to streams. The input file is then
+    memory-mapped by qpdf. For PyPDF2, files smaller than
+    MAX_IN_MEMORY_SIZE are read at once: a single sequential read is
+    much faster than the many small reads of PyPDF2, in particular on
+    network file systems. Larger files are memory-mapped.
+
     Args:
         istream: The input PDF (string or stream in 'rb' mode).
         ostream: The output PDF (string or stream in 'wb' mode).
         author: The '/Author' metadata (string).
         title: The '/Title' metadata (string).
     """
+    pikepdf = import_pikepdf()
+    if pikepdf is not None:
+        with pikepdf.open(istream) as pdf:
+            with pdf.open_metadata() as metadata:
+                metadata['dc:creator'] = [author]
+                metadata['dc:title'] = title
+            pdf.save(ostream)
+        return
+
+    if isinstance(ostream, str):
+        with open(ostream, 'wb') as f:
+            return add_metadata(istream, f, author, title)
+    if isinstance(istream, str):
+        with open(istream, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= MAX_IN_MEMORY_SIZE:
+                return add_metadata(io.BytesIO(f.read()), ostream, author,
+                                    title)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return add_metadata(m, ostream, author, title)
+
+    import PyPDF2
     reader = PyPDF2.PdfFileReader(istream)
     writer = PyPDF2.PdfFileWriter()
     writer.appendPagesFromReader(reader)
@@ -49,3 +196,469 @@ def add_metadata(istream, ostream, author, title):
                         '/Title': title})
     copy_bookmarks(reader, writer)
     writer.write(ostream)
+
+
+def find_startxref(stream):
+    """Return the offset of the last cross-reference section of a PDF.
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+
+    Raises:
+        ValueError: The startxref keyword, followed by an offset, could
+            not be found at the end of the file.
+    """
+    stream.seek(0, os.SEEK_END)
+    stream.seek(max(0, stream.tell()-1024))
+    tail = stream.read()
+    index = tail.rfind(b'startxref')
+    offset = tail[index+len(b'startxref'):].split()[:1]
+    if index < 0 or not offset or not offset[0].isdigit():
+        raise ValueError('could not find startxref')
+    return int(offset[0])
+
+
+def copy_stream(istream, ostream):
+    """Copy the whole contents of istream at the end of ostream.
+
+    On Linux, the bytes are copied by the kernel (os.sendfile), without
+    going through user space. Otherwise, shutil.copyfileobj is used
+    with a large buffer.
+
+    Args:
+        istream: The input file (stream in 'rb' mode).
+        ostream: The output file (stream in 'wb' mode).
+    """
+    ostream.flush()
+    # The input is read once, from beginning to end: this allows the
+    # kernel to read ahead more aggressively
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(istream.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    offset = 0
+    if sys.platform.startswith('linux'):
+        size = os.fstat(istream.fileno()).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(ostream.fileno(), istream.fileno(),
+                                   offset, size-offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # Fall back to copyfileobj, unless the copy has started
+            if offset > 0:
+                raise
+        # The position of ostream is stale after sendfile
+        ostream.seek(0, os.SEEK_END)
+        if offset == size:
+            return
+    istream.seek(offset)
+    shutil.copyfileobj(istream, ostream, COPY_BUFFER_SIZE)
+
+
+def read_xref_section(stream, offset):
+    """Return the cross-reference section at offset, as raw bytes.
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        offset: The offset of the cross-reference section (see
+            find_startxref).
+
+    Returns:
+        A (table, trailer) pair. For classic cross-reference tables
+        (introduced by the xref keyword), table holds the subsections
+        and trailer the dictionary that follows the trailer keyword.
+        For cross-reference streams, table is None and trailer is the
+        dictionary of the stream, which holds the same entries (the
+        stream itself is not decoded). None is returned if no
+        cross-reference section could be found at offset.
+    """
+    # The section must start at a token boundary: an offset within a
+    # keyword or an object number is invalid
+    if offset > 0:
+        stream.seek(offset-1)
+        if stream.read(1) not in PDF_WHITESPACE:
+            return None
+    stream.seek(offset)
+    data = bytearray(stream.read(COPY_BUFFER_SIZE))
+    if data.startswith(b'xref'):
+        # The cross-reference entries only hold digits, 'f' and 'n': the
+        # first occurrence of the trailer keyword is the right one
+        start, end_keyword = b'trailer', b'startxref'
+    elif OBJECT_HEADER_RE.match(data):
+        start, end_keyword = b'obj', b'stream'
+    else:
+        return None
+    while True:
+        begin = data.find(start)
+        end = data.find(end_keyword, begin) if begin >= 0 else -1
+        if end >= 0:
+            break
+        chunk = stream.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            return None
+        data += chunk
+    table = bytes(data[:begin]) if start == b'trailer' else None
+    return table, bytes(data[begin:end])
+
+
+def read_trailer(stream, offset):
+    """Return the trailer of the cross-reference section at offset.
+
+    The trailer is parsed without PyPDF2 (see read_xref_section). Only
+    the entries that are needed to append an incremental update are
+    retrieved: /Size, /Root, /ID, /Info and /Encrypt (the last three,
+    if present).
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        offset: The offset of the cross-reference section (see
+            find_startxref).
+
+    Returns:
+        A dictionary that maps the names of the entries (e.g. b'/Root')
+        to their raw values (e.g. b'1 0 R'), None if the trailer could
+        not be parsed.
+    """
+    section = read_xref_section(stream, offset)
+    if section is None:
+        return None
+    table, trailer = section
+    if table is None and b'/XRef' not in trailer:
+        # Not a cross-reference stream
+        return None
+
+    size = TRAILER_SIZE_RE.search(trailer)
+    root = TRAILER_ROOT_RE.search(trailer)
+    if size is None or root is None:
+        return None
+    entries = {b'/Size': size.group(1), b'/Root': root.group(1)}
+    if b'/ID' in trailer:
+        # The file identifiers are nearly always hexadecimal strings
+        id_ = TRAILER_ID_RE.search(trailer)
+        if id_ is None:
+            return None
+        entries[b'/ID'] = id_.group(1)
+    info = TRAILER_INFO_RE.search(trailer)
+    if info is not None:
+        entries[b'/Info'] = info.group(1)
+    if b'/Encrypt' in trailer:
+        entries[b'/Encrypt'] = None
+    return entries
+
+
+def object_offset(stream, offset, num):
+    """Return the offset of the object with the specified number.
+
+    The classic cross-reference tables are looked up by hand, starting
+    from the section at offset and following the /Prev entries of the
+    trailers, so that the most recent definition of the object is
+    found.
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        offset: The offset of the last cross-reference section (see
+            find_startxref).
+        num: The object number.
+
+    Returns:
+        The offset of the object, None if it could not be found (e.g.
+        cross-reference streams, or objects stored in object streams).
+    """
+    visited = set()
+    while offset not in visited:
+        visited.add(offset)
+        section = read_xref_section(stream, offset)
+        if section is None or section[0] is None:
+            return None
+        table, trailer = section
+        tokens = table.split()
+        try:
+            # tokens[0] is the xref keyword, followed by subsections:
+            # first object number, number of entries, then the entries
+            # (offset, generation, keyword)
+            i = 1
+            while i < len(tokens):
+                first, count = int(tokens[i]), int(tokens[i+1])
+                if first <= num < first+count:
+                    j = i+2+3*(num-first)
+                    if tokens[j+2] != b'n':
+                        return None
+                    return int(tokens[j])
+                i += 2+3*count
+        except (ValueError, IndexError):
+            return None
+        prev = TRAILER_PREV_RE.search(trailer)
+        if prev is None:
+            return None
+        offset = int(prev.group(1))
+    return None
+
+
+def read_object(stream, offset):
+    """Return the raw bytes of the indirect object at offset.
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        offset: The offset of the object (see object_offset).
+
+    Returns:
+        The bytes from the object header to the endobj keyword
+        (excluded), None if no object could be found at offset.
+    """
+    stream.seek(offset)
+    data = bytearray(stream.read(COPY_BUFFER_SIZE))
+    if not OBJECT_HEADER_RE.match(data):
+        return None
+    while True:
+        end = data.find(b'endobj')
+        if end >= 0:
+            return bytes(data[:end])
+        chunk = stream.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            return None
+        data += chunk
+
+
+def has_xmp_metadata(stream, trailer, prev):
+    """Return True if the catalog of the PDF file has a /Metadata entry.
+
+    The /Metadata entry of the catalog refers to an XMP metadata
+    stream, which takes precedence over the /Info dictionary in many
+    viewers and indexers. The catalog is read by hand if possible (see
+    object_offset), and by PyPDF2 otherwise.
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        trailer: The trailer of the PDF file (see read_trailer).
+        prev: The offset of the last cross-reference section of the PDF
+            file (see find_startxref).
+    """
+    root_num = int(trailer[b'/Root'].split()[0])
+    offset = object_offset(stream, prev, root_num)
+    catalog = read_object(stream, offset) if offset is not None else None
+    if catalog is None:
+        return has_xmp_metadata_pypdf2(stream)
+    return b'/Metadata' in catalog
+
+
+def read_string(data, pos):
+    """Return the PDF string object that starts at data[pos].
+
+    Both literal and hexadecimal strings are supported.
+
+    Returns:
+        The bytes of the string, None if it is malformed.
+    """
+    if data[pos:pos+1] == b'<':
+        end = data.find(b'>', pos)
+        if end < 0:
+            return None
+        digits = re.sub(rb'\s', b'', data[pos+1:end])
+        if len(digits) % 2 == 1:
+            digits += b'0'
+        try:
+            return bytes.fromhex(digits.decode('ascii'))
+        except ValueError:
+            return None
+    out = bytearray()
+    depth = 1
+    i = pos+1
+    while i < len(data):
+        char = data[i:i+1]
+        if char == b'\\':
+            escaped = data[i+1:i+2]
+            octal = re.match(rb'[0-7]{1,3}', data[i+1:i+4])
+            if escaped in LITERAL_ESCAPES:
+                out += LITERAL_ESCAPES[escaped]
+                i += 2
+            elif octal is not None:
+                out.append(int(octal.group(), 8) & 0xFF)
+                i += 1+len(octal.group())
+            elif escaped in (b'\r', b'\n'):
+                # Backslash at the end of a line: line continuation
+                i += 3 if data[i+1:i+3] == b'\r\n' else 2
+            else:
+                # The backslash of unknown escape sequences is ignored
+                i += 1
+            continue
+        if char == b'(':
+            depth += 1
+        elif char == b')':
+            depth -= 1
+            if depth == 0:
+                return bytes(out)
+        elif char == b'\r':
+            # End of line markers are read as line feeds
+            char = b'\n'
+            if data[i+1:i+2] == b'\n':
+                i += 1
+        out += char
+        i += 1
+    return None
+
+
+def decode_text_string(data):
+    """Return the text that the PDF text string data represents.
+
+    Only UTF-16BE (with byte order mark) and ASCII text strings are
+    decoded.
+
+    Returns:
+        The text (string), None if it could not be decoded.
+    """
+    try:
+        if data.startswith(codecs.BOM_UTF16_BE):
+            return data[len(codecs.BOM_UTF16_BE):].decode('utf-16-be')
+        return data.decode('ascii')
+    except UnicodeDecodeError:
+        return None
+
+
+def read_info(stream, trailer, prev):
+    """Return the author and title held by the /Info dictionary.
+
+    The /Info dictionary is read by hand (see object_offset), and only
+    direct text strings are decoded (see decode_text_string).
+
+    Args:
+        stream: The PDF file (stream in 'rb' mode).
+        trailer: The trailer of the PDF file (see read_trailer).
+        prev: The offset of the last cross-reference section of the PDF
+            file (see find_startxref).
+
+    Returns:
+        An (author, title) pair. Missing entries, or entries that could
+        not be read, are None.
+    """
+    entries = {}
+    if b'/Info' in trailer:
+        info_num = int(trailer[b'/Info'].split()[0])
+        offset = object_offset(stream, prev, info_num)
+        info = read_object(stream, offset) if offset is not None else None
+        if info is not None:
+            for match in INFO_ENTRY_RE.finditer(info):
+                data = read_string(info, match.start(2))
+                if data is not None:
+                    entries[match.group(1)] = decode_text_string(data)
+    return entries.get(b'Author'), entries.get(b'Title')
+
+
+def has_xmp_metadata_pypdf2(stream):
+    """Return True if the catalog of the PDF file has a /Metadata entry.
+
+    This function is a fallback to has_xmp_metadata, for the files whose
+    catalog it could not read.
+
+    Raises:
+        ValueError: PyPDF2 could not read the catalog.
+    """
+    import PyPDF2
+    try:
+        return '/Metadata' in PyPDF2.PdfFileReader(stream).trailer['/Root']
+    except Exception as e:
+        # PyPDF2 raises all sorts of exceptions on invalid files
+        raise ValueError('could not read catalog') from e
+
+
+def text_string(text):
+    """Return the PDF text string object that represents text.
+
+    Printable ASCII text is written as a literal string. Otherwise, text
+    is encoded in UTF-16BE (with byte order mark), and written as a
+    hexadecimal string.
+
+    Args:
+        text: The text to be represented (string).
+
+    Returns:
+        The PDF string object (bytes).
+    """
+    if not (text.isascii() and text.isprintable()):
+        data = codecs.BOM_UTF16_BE+text.encode('utf-16-be')
+        return b'<'+data.hex().encode('ascii')+b'>'
+    data = text.encode('ascii')
+    for char, escaped in ((b'\\', b'\\\\'), (b'(', b'\\('), (b')', b'\\)')):
+        data = data.replace(char, escaped)
+    return b'('+data+b')'
+
+
+def add_metadata_incremental(path_in, path_out, author, title):
+    """Add author and title metadata to PDF file, without rewriting it.
+
+    The input file is copied verbatim, and an incremental update
+    (see section 7.5.6 of the PDF specification) that defines a new
+    /Info dictionary is appended to the copy. Pages and bookmarks are
+    therefore neither parsed nor re-serialized, and the cost of this
+    function is essentially that of a file copy. Use add_metadata if
+    the whole file must be rewritten.
+
+    The trailer and the catalog are parsed by hand (see read_trailer
+    and has_xmp_metadata). PyPDF2 is only used to read catalogs that
+    could not be found by hand (e.g. in cross-reference streams).
+
+    Like add_metadata, the new /Info dictionary only holds the /Author
+    and /Title entries. If the /Info dictionary of the input PDF already
+    holds the specified author and title (see read_info), the input PDF
+    is merely copied. The XMP metadata stream is not updated: files
+    that have one are not supported, since their XMP metadata would
+    then contradict the new /Info dictionary.
+
+    Args:
+        path_in: The path to the input PDF.
+        path_out: The path to the output PDF.
+        author: The '/Author' metadata (string).
+        title: The '/Title' metadata (string).
+
+    Raises:
+        ValueError: The input PDF is encrypted, has XMP metadata, or
+            its trailer or catalog could not be read (e.g. damaged
+            files, which add_metadata may still be able to rewrite).
+    """
+    with open(path_in, 'rb') as istream:
+        prev = find_startxref(istream)
+        trailer = read_trailer(istream, prev)
+        if trailer is None:
+            # The update is chained to the section at prev (/Prev entry),
+            # which must therefore be valid
+            raise ValueError('could not read trailer')
+        if b'/Encrypt' in trailer:
+            raise ValueError('encrypted PDF files are not supported')
+        if has_xmp_metadata(istream, trailer, prev):
+            raise ValueError('PDF files with XMP metadata are not supported')
+        up_to_date = read_info(istream, trailer, prev) == (author, title)
+        with open(path_out, 'wb') as ostream:
+            copy_stream(istream, ostream)
+            if not up_to_date:
+                append_info(ostream, trailer, prev, author, title)
+
+
+def append_info(ostream, trailer, prev, author, title):
+    """Append an incremental update that defines a new /Info dictionary.
+
+    Args:
+        ostream: The copy of the PDF file (stream in 'wb' mode),
+            positioned at its end.
+        trailer: The trailer of the PDF file (see read_trailer).
+        prev: The offset of the last cross-reference section of the PDF
+            file (see find_startxref).
+        author: The '/Author' metadata (string).
+        title: The '/Title' metadata (string).
+    """
+    info_num = int(trailer[b'/Size'])
+    ostream.write(b'\n')
+    info_offset = ostream.tell()
+    ostream.write('{} 0 obj\n'.format(info_num).encode('ascii'))
+    ostream.write(b'<<\n/Author '+text_string(author)+
+                  b'\n/Title '+text_string(title)+b'\n>>\nendobj\n')
+    xref_offset = ostream.tell()
+    ostream.write('xref\n0 1\n0000000000 65535 f \n'
+                  '{} 1\n{:010d} 00000 n \n'.format(
+                      info_num, info_offset).encode('ascii'))
+    ostream.write('trailer\n<<\n/Size {}\n/Info {} 0 R\n/Prev {}\n'.format(
+        info_num+1, info_num, prev).encode('ascii'))
+    ostream.write(b'/Root '+trailer[b'/Root']+b'\n')
+    if b'/ID' in trailer:
+        ostream.write(b'/ID '+trailer[b'/ID']+b'\n')
+    ostream.write('>>\nstartxref\n{}\n%%EOF\n'.format(
+        xref_offset).encode('ascii'))
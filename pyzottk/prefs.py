@@ -1,11 +1,14 @@
 """This module provides functions to locate and parse the prefs.js file.
 """
-import glob
-import os.path
+import os
 import re
 import sys
 
 
+_USER_PREF_RE = re.compile(r'^user_pref\("([a-zA-Z.]*)"\s*,\s*(.*)\);\r?$',
+                           re.MULTILINE)
+
+
 def locate():
     """Return a list of ``prefs.js`` preference files.
 
@@ -21,8 +24,13 @@ def locate():
         paths = [os.environ['APPDATA'], 'Zotero', 'Zotero', 'Profiles']
     elif sys.platform.startswith('linux'):
         paths = [home, '.zotero', 'Profiles']
-    paths += ['*', 'prefs.js']
-    return glob.glob(os.path.join(*paths))
+    try:
+        entries = list(os.scandir(os.path.join(*paths)))
+    except OSError:
+        return []
+    candidates = (os.path.join(entry.path, 'prefs.js')
+                  for entry in entries if entry.is_dir())
+    return [path for path in candidates if os.path.isfile(path)]
 
 
 def select():
@@ -60,10 +68,13 @@ def parse(path):
     Returns:
         A dictionary of preferences.
     """
-    prog = re.compile('^user_pref\("([a-zA-Z.]*)"\s*,\s*(.*)\);$')
-    with open(path, 'r') as f:
-        lines = (bytes(line, 'utf-8').decode('unicode_escape') for line in f)
-        matches = (prog.match(line) for line in lines)
-        prefs = {match.group(1): match.group(2).strip('"\'')
-                 for match in matches if match}
-        return prefs
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Without any backslash, decoding escape sequences amounts to a
+    # latin-1 decoding, which is much cheaper
+    if b'\\' in data:
+        text = data.decode('unicode_escape')
+    else:
+        text = data.decode('latin-1')
+    return {match.group(1): match.group(2).strip('"\'')
+            for match in _USER_PREF_RE.finditer(text)}
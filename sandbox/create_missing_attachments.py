@@ -31,17 +31,37 @@ config file. Its structure is given below:
     https =
 
 """
+import concurrent.futures
 import configparser
 import datetime
-import glob
+import fnmatch
+import functools
 import itertools
 import logging
 import os.path
 
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is much faster than the json module, but optional
+try:
+    from orjson import loads as parse_json
+except ImportError:
+    from json import loads as parse_json
+
 BASE_URL = 'https://api.zotero.org'
 
+# URL template, to be formatted with the user's Zotero ID
+ITEMS_TOP_URL = BASE_URL + '/users/{}/items/top'
+
+SESSION = requests.Session()
+SESSION.mount('https://',
+              HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.5,
+                                            status_forcelist=(429, 500, 502,
+                                                              503, 504))))
+
 
 class MyException(Exception):
     def __init__(self, msg):
@@ -59,16 +79,18 @@ class TooManyChildrenException(MyException):
     pass
 
 
-def get_children(item_key, user_ID, key, proxies):
-    """Return the list of children of a specified Zotero item.
+@functools.lru_cache(maxsize=4096)
+def list_directory(path):
+    """Return the names of the entries in the specified directory.
 
-    The function returns the keys to all children.
+    The result is cached, so that each directory is listed only once.
+    An empty tuple is returned if the directory cannot be listed
+    (typically, because it does not exist).
     """
-    params = {'v': '3', 'key': key, 'format': 'json'}
-    url = '/'.join([BASE_URL, 'users', user_ID,
-                    'items', item_key, 'children'])
-    return [i['key']
-            for i in requests.get(url, params, proxies=proxies).json()]
+    try:
+        return tuple(os.listdir(path))
+    except OSError:
+        return ()
 
 
 def locate_child(call_number, base_attachment_path, pattern='*.pdf'):
@@ -96,9 +118,13 @@ def locate_child(call_number, base_attachment_path, pattern='*.pdf'):
         TooManyChildrenException: More than one file matching the
             pattern is found.
     """
-    path = os.path.join(base_attachment_path, call_number[0], call_number,
-                        pattern)
-    children = glob.glob(path)
+    names = list_directory(os.path.join(base_attachment_path,
+                                        call_number[0], call_number))
+    # Like glob, skip hidden files unless the pattern explicitly
+    # matches them
+    if not pattern.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    children = fnmatch.filter(names, pattern)
     if len(children) == 0:
         raise NoChildrenException(call_number)
     elif len(children) >= 2:
@@ -106,7 +132,28 @@ def locate_child(call_number, base_attachment_path, pattern='*.pdf'):
     else:
         return ('attachments:' + '/'.join((call_number[0],
                                            call_number,
-                                           os.path.basename(children[0]))))
+                                           children[0])))
+
+
+# Templates of new items, keyed by (itemType, linkMode)
+_TEMPLATES = {}
+
+
+def get_template(item_type, link_mode, proxies):
+    """Return the template of new Zotero items of the specified type.
+
+    Templates do not change during a session, so each of them is
+    retrieved from the Zotero API only once.
+    """
+    template_key = (item_type, link_mode)
+    if template_key not in _TEMPLATES:
+        params = {'v': '3',
+                  'format': 'json',
+                  'itemType': item_type,
+                  'linkMode': link_mode}
+        r = SESSION.get(BASE_URL+'/items/new', params=params, proxies=proxies)
+        _TEMPLATES[template_key] = parse_json(r.content)
+    return _TEMPLATES[template_key]
 
 
 def create_attachments(items, user_ID, key, proxies):
@@ -124,12 +171,8 @@ def create_attachments(items, user_ID, key, proxies):
     """
     params = {'v': '3',
               'key': key,
-              'format': 'json',
-              'itemType': 'attachment',
-              'linkMode': 'linked_file'}
-    template = requests.get(BASE_URL+'/items/new',
-                            params=params,
-                            proxies=proxies).json()
+              'format': 'json'}
+    template = get_template('attachment', 'linked_file', proxies)
     data = []
     for parent_item, path, title in items:
         item = template.copy()
@@ -138,10 +181,10 @@ def create_attachments(items, user_ID, key, proxies):
         item['path'] = path
         item['title'] = title if title else os.path.basename(path)
         data.append(item)
-    # return requests.post(BASE_URL+'/users/'+user_ID+'/items/',
-    #                      data=json.dumps(data),
-    #                      params=params,
-    #                      proxies=proxies)
+    # return SESSION.post(BASE_URL+'/users/'+user_ID+'/items/',
+    #                     data=json.dumps(data),
+    #                     params=params,
+    #                     proxies=proxies)
     return None
 
 
@@ -173,20 +216,23 @@ def add_missing_attachments(start, limit, user_ID, key, proxies,
               'key': key,
               'format': 'json',
               'include': 'data',
+              'itemType': '-attachment',
               'sort': 'creator',
               'limit': str(limit),
               'start': str(start)}
-    url = '/'.join([BASE_URL, 'users', user_ID, 'items', 'top'])
-    items = requests.get(url, params, proxies=proxies).json()
+    url = ITEMS_TOP_URL.format(user_ID)
+    r = SESSION.get(url, params=params, proxies=proxies)
+    items = parse_json(r.content)
 
+    # The number of children is returned along with each item, there is
+    # no need to retrieve the children themselves
     new_items = []
     for item in items:
         data = item['data']
         parent_item = data['key']
-        if get_children(parent_item, user_ID, key, proxies) == []:
-            call_number = data['callNumber'] if 'callNumber' in data else ''
+        if item['meta'].get('numChildren', 0) == 0:
+            call_number = (data.get('callNumber') or '').lower()
             if call_number:
-                call_number = data['callNumber'].lower()
                 try:
                     path = locate_child(call_number, base_attachment_path)
                     new_items.append((parent_item, path, None))
@@ -197,11 +243,15 @@ def add_missing_attachments(start, limit, user_ID, key, proxies,
                     logging.warning('Too many children found for '+call_number)
             else:
                 logging.warning('No call number for item: '+data['title'])
-    return len(items), create_attachments(new_items)
+    return len(items), create_attachments(new_items, user_ID, key, proxies)
 
 
 def get_items(user_ID, key, proxies):
-    """Return a list of all items in the Zotero database."""
+    """Return a list of all items in the Zotero database.
+
+    The next page of items is requested in a background thread while
+    the current page is being decoded.
+    """
     limit = 100
     params = {'v': '3',
               'key': key,
@@ -209,15 +259,25 @@ def get_items(user_ID, key, proxies):
               'include': 'data',
               'sort': 'creator',
               'limit': str(limit)}
-    url = '/'.join([BASE_URL, 'users', user_ID, 'items', 'top'])
+    url = ITEMS_TOP_URL.format(user_ID)
+
+    def get_page(start):
+        return SESSION.get(url, params=dict(params, start=str(start)),
+                           proxies=proxies)
+
     items = []
-    for start in itertools.count(step=100):
-        params['start'] = str(start)
-        r = requests.get(url, params, proxies=proxies).json()
-        items += r
-        if len(r) < limit:
-            break
-        print(start, len(r))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(get_page, 0)
+        for start in itertools.count(step=limit):
+            response = future.result()
+            has_next = 'next' in response.links
+            if has_next:
+                future = executor.submit(get_page, start+limit)
+            r = parse_json(response.content)
+            items += r
+            if not has_next:
+                break
+            print(start, len(r))
     return items
 
 
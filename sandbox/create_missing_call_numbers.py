@@ -17,19 +17,31 @@ API. Logging infos are stored in the file ``pyzottk.log``.
 
 import configparser
 import datetime
-import json
 import logging
 import os.path
 import sqlite3
 
 import requests
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 
 BASE_URL = 'https://api.zotero.org'
 
+# Maximum number of objects per write request to the Zotero API
+MAX_OBJECTS_PER_WRITE = 50
+
+SESSION = requests.Session()
+SESSION.mount('https://',
+              HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                          max_retries=Retry(total=5, backoff_factor=0.5,
+                                            status_forcelist=(429, 500, 502,
+                                                              503, 504))))
+
 
 def call_number_from_path(path):
-    return path.split('/')[-2].upper()
+    return path.rsplit('/', 2)[-2].upper()
 
 
 if __name__ == '__main__':
@@ -44,39 +56,52 @@ if __name__ == '__main__':
                                               'zotero.sqlite'))
     cursor = connection.cursor()
 
-    # Find ID of collection that holds the items with no call number
+    # Find the attachments of the items in the collection that holds the
+    # items with no call number
     collectionName = 'no_call_number'
-    query = 'SELECT collectionID FROM collections WHERE collectionName=?'
-    cursor.execute(query, (collectionName,))
-    collectionID = cursor.fetchone()[0]
-
-    subquery = ('SELECT itemID FROM collectionItems '
-                'WHERE collectionID = {}'.format(collectionID))
-    query = ('SELECT items.itemID, items.key, items.version, '
-             'itemAttachments.path '
+    query = ('SELECT items.key, items.version, itemAttachments.path '
              'FROM items INNER JOIN itemAttachments '
              'ON items.itemID = itemAttachments.parentItemID '
-             'WHERE items.itemID IN ({})'.format(subquery))
-    cursor.execute(query)
+             'INNER JOIN collectionItems '
+             'ON items.itemID = collectionItems.itemID '
+             'INNER JOIN collections '
+             'ON collectionItems.collectionID = collections.collectionID '
+             'WHERE collections.collectionName = ?')
+    cursor.execute(query, (collectionName,))
+    rows = cursor.fetchall()
 
     key_to_callNumber_and_version = {k: (call_number_from_path(p), v)
-                                     for _, k, v, p in cursor}
+                                     for k, v, p in rows}
 
     num_call_numbers = len(key_to_callNumber_and_version)
     print('{} call numbers will be created'.format(num_call_numbers))
 
     connection.close()
 
-    user_prefix = '/'.join([BASE_URL, 'users', cfg['credentials']['user_ID']])
+    user_prefix = BASE_URL+'/users/'+cfg['credentials']['user_ID']
     params = {'v': 3, 'key': cfg['credentials']['key'], 'format': 'json'}
     proxies = dict(cfg['proxies'])
 
-    for key, (callNumber, version) in key_to_callNumber_and_version.items():
-        url = '/'.join([user_prefix, 'items', key])
-        data = {'callNumber': callNumber}
-        headers = {'If-Unmodified-Since-Version': str(version)}
-        r = requests.patch(url=url, data=json.dumps(data), headers=headers,
-                           params=params, proxies=proxies)
-        logging.info('{}: {}'.format(callNumber, r.status_code))
+    # Items are updated in batches. The version of each item is checked
+    # by the server, just like the If-Unmodified-Since-Version header
+    # would for single item requests.
+    url = user_prefix+'/items'
+    updates = list(key_to_callNumber_and_version.items())
+    for start in range(0, len(updates), MAX_OBJECTS_PER_WRITE):
+        batch = updates[start:start+MAX_OBJECTS_PER_WRITE]
+        data = [{'key': key, 'version': version, 'callNumber': callNumber}
+                for key, (callNumber, version) in batch]
+        r = SESSION.post(url=url, json=data, params=params,
+                         proxies=proxies)
+        if r.status_code != 200:
+            logging.error('batch {}: {}'.format(start, r.status_code))
+            continue
+        failed = r.json()['failed']
+        for index, (key, (callNumber, version)) in enumerate(batch):
+            if str(index) in failed:
+                logging.info('{}: {}'.format(callNumber,
+                                             failed[str(index)]['code']))
+            else:
+                logging.info('{}: {}'.format(callNumber, r.status_code))
 
     logging.info('--------------------------------------------------')
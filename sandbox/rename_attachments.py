@@ -4,7 +4,6 @@ For a top-level item with call number ``DOE2017``, the path to the
 attachment should be ``attachments:d/doe2017/doe2017.pdf``.
 """
 import configparser
-import json
 import os.path
 import sqlite3
 
@@ -13,6 +12,9 @@ import requests
 BASE_URL = 'https://api.zotero.org'
 PATH_PREFIX = 'attachments:'
 
+# Maximum number of objects in a single write request to the Zotero API
+MAX_OBJECTS_PER_WRITE = 50
+
 
 def expected_attachment_path(actual):
     elements = actual[len(PATH_PREFIX):].split('/')
@@ -24,8 +26,10 @@ def expected_attachment_path(actual):
 
 
 def expand_path(path, base_attachment_path):
-    elements = path[len(PATH_PREFIX):].split('/')
-    return os.path.join(base_attachment_path, *elements)
+    relative_path = path[len(PATH_PREFIX):]
+    if os.sep != '/':
+        relative_path = relative_path.replace('/', os.sep)
+    return os.path.join(base_attachment_path, relative_path)
 
 
 if __name__ == '__main__':
@@ -36,35 +40,18 @@ if __name__ == '__main__':
                                               'zotero.sqlite'))
     cursor = connection.cursor()
 
-    # First retrieve a list of (itemID, path) pairs:
-    #
-    #   - itemID: the ID of the attachment
-    #   - path: the path to the attachment
-    query = ('SELECT itemAttachments.itemID, itemAttachments.path '
-             'FROM items INNER JOIN itemAttachments '
-             'ON items.itemID = itemAttachments.parentItemID')
+    # Retrieve the key, version and path of all attachments to a parent
+    # item. Attachments are items themselves: the items table is joined
+    # twice, once for the attachment and once for its parent.
+    query = ('SELECT attachments.key, attachments.version, '
+             'itemAttachments.path '
+             'FROM itemAttachments '
+             'INNER JOIN items AS attachments '
+             'ON attachments.itemID = itemAttachments.itemID '
+             'INNER JOIN items AS parents '
+             'ON parents.itemID = itemAttachments.parentItemID')
     cursor.execute(query)
 
-    # Now build a list of itemID, path_old, path_new) triplets:
-    #
-    #   - itemID: the ID of the attachment
-    #   - path_old: the actual path to the attachment
-    #   - path_new: the expected path to the attachment
-    #
-    # Only th items for which these two paths differ are kept.
-    items = []
-    for itemID, path_actual in cursor:
-        path_expected = expected_attachment_path(path_actual)
-        if path_expected != path_actual:
-            items.append((itemID, path_actual, path_expected))
-
-    item_ID_to_paths = {item_ID: (path_old, path_new)
-                        for item_ID, path_old, path_new in items}
-
-    query = ('SELECT items.itemID, items.key, items.version '
-             'FROM items WHERE items.itemID in ({})')
-    cursor.execute(query.format(','.join(map(str, item_ID_to_paths.keys()))))
-
     # Now build a list of (key, version, path_old, path_new) tuples:
     #
     #   - key: the key of the attachment
@@ -73,16 +60,24 @@ if __name__ == '__main__':
     #   - path_new: the expected path to the attachment
     #
     # Only th items for which these two paths differ are kept.
-    items = [(key, version, *item_ID_to_paths[item_ID])
-             for item_ID, key, version in cursor]
+    items = []
+    for key, version, path_actual in cursor:
+        path_expected = expected_attachment_path(path_actual)
+        if path_expected != path_actual:
+            items.append((key, version, path_actual, path_expected))
 
     connection.close()
 
     base_attachment_path = cfg['local']['base_attachment_path']
-    user_prefix = '/'.join([BASE_URL, 'users', cfg['credentials']['user_id']])
+    user_prefix = BASE_URL + '/users/' + cfg['credentials']['user_id']
     params = {'v': 3, 'key': cfg['credentials']['key'], 'format': 'json'}
     proxies = dict(cfg['proxies'])
 
+    session = requests.Session()
+    session.params = params
+    session.proxies = proxies
+
+    updates = []
     for key, version, path_old, path_new in items:
         filename_old = path_old.split('/')[-1]
         filename_new = path_new.split('/')[-1]
@@ -93,14 +88,11 @@ if __name__ == '__main__':
         # Uncomment this line if to actually perform the changes
         # os.rename(path_old_exp, path_new_exp)
 
-        # Update database through the API
-        url = '/'.join([user_prefix, 'items', key])
-        data = {'title': filename_new,
-                'path': path_new}
-        headers = {'If-Unmodified-Since-Version': str(version)}
-        # Uncomment this line if to actually perform the changes
-        # r = requests.patch(url=url, data=json.dumps(data),
-        #                    headers=headers, params=params, proxies)
+        # The version of each item is checked by the server, just like
+        # the If-Unmodified-Since-Version header would for single item
+        # requests
+        updates.append({'key': key, 'version': version,
+                        'title': filename_new, 'path': path_new})
 
         print('key:     {}'.format(key))
         print('version: {}'.format(version))
@@ -108,4 +100,16 @@ if __name__ == '__main__':
         print('old path: {}, {}'.format(path_old, path_old_exp))
         print('new path: {}, {}'.format(path_new, path_new_exp))
         print('')
-        # print('status code: {}'.format(r.status_code))
+
+    # Update database through the API, in batches
+    url = user_prefix + '/items'
+    for start in range(0, len(updates), MAX_OBJECTS_PER_WRITE):
+        batch = updates[start:start+MAX_OBJECTS_PER_WRITE]
+        # Uncomment these lines if to actually perform the changes
+        # r = session.post(url, json=batch)
+        # print('batch {}: status code {}'.format(start, r.status_code))
+        # for index, error in r.json()['failed'].items():
+        #     print('{}: {}'.format(batch[int(index)]['key'],
+        #                           error['message']))
+
+    session.close()
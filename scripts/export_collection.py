@@ -6,17 +6,31 @@ retrieves the attached PDF file, and exports it to the specified
 destination. The metadata (author and title) of the exported PDF file
 are updated according to the item data.
 """
+import concurrent.futures
 import configparser
-import itertools
+import functools
+import multiprocessing
 import os
+import pickle
 import sys
+import tempfile
+import threading
+import time
 
 import requests
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from pyzottk.attachment import full_path
-from pyzottk.pdf import add_metadata
+from pyzottk.pdf import add_metadata, add_metadata_incremental, has_metadata
+
+# orjson is much faster than the json module, but optional
+try:
+    from orjson import loads as parse_json
+except ImportError:
+    from json import loads as parse_json
 
 BASE_URL = 'https://api.zotero.org'
 
@@ -26,12 +40,22 @@ COLLECTION_HELP = 'name of collection to export'
 
 EXPORT_PATH_HELP = 'full path to export directory'
 
-ITEMS_PER_REQUEST = 10
+ITEMS_PER_REQUEST = 100
 
-def parse_config():
-    """Return the contents of the pyzottk configuration file.
+# Maximum number of concurrent requests to the Zotero API
+MAX_WORKERS = 8
 
-    This function returns an instance of ``configparser.ConfigParser``.
+# Retry strategy for transient errors of the Zotero API
+RETRY = Retry(total=5, backoff_factor=0.5,
+              status_forcelist=(429, 500, 502, 503, 504),
+              respect_retry_after_header=True)
+
+
+@functools.lru_cache(maxsize=1)
+def config_directory():
+    """Return the path to the directory of the pyzottk configuration file.
+
+    The path is computed once per run.
     """
     home = os.path.expanduser('~')
     if sys.platform.startswith('darwin'):
@@ -40,12 +64,19 @@ def parse_config():
         paths = [os.environ['APPDATA'], 'pyzottk']
     elif sys.platform.startswith('linux'):
         paths = [home, '.pyzottk']
-    paths += ['pyzottk.cfg']
-    path = os.path.join(*paths)
-    if not(os.path.isfile(path)):
-        raise RuntimeError('could not find config file: '+path)
+    return os.path.join(*paths)
+
+
+def parse_config():
+    """Return the contents of the pyzottk configuration file.
+
+    This function returns an instance of ``configparser.ConfigParser``.
+    """
+    path = os.path.join(config_directory(), 'pyzottk.cfg')
     cfg = configparser.ConfigParser()
-    cfg.read(os.path.join(*paths))
+    # read() silently skips missing files, and returns those it did read
+    if not cfg.read(path):
+        raise RuntimeError('could not find config file: '+path)
     return cfg
 
 
@@ -58,96 +89,352 @@ def setup_argument_parser():
 
 
 def full_name(first_name, last_name):
-    out = first_name
-    if out != '' and last_name != '':
-        out += ' '
-    out += last_name
-    return out
-
-
-def get_collections(user_prefix, params, proxies):
-    url = '/'.join([user_prefix, 'collections'])
-    collections = []
-    for i in itertools.count(0):
-        r = requests.get(url=url, params=params, proxies=proxies)
-        r_json = r.json()
-        collections += r_json
-        if len(r_json) < ITEMS_PER_REQUEST:
-            params['start'] = 0
-            return collections
-        params['start'] += ITEMS_PER_REQUEST
+    return ' '.join(filter(None, (first_name, last_name)))
+
+
+def export_attachment(iname, oname, author, title):
+    """Export the attachment iname to oname, adding author and title.
+
+    Nothing is done if oname is more recent than iname and already has
+    the right metadata (typically, when a collection is exported
+    again). Otherwise, the metadata is appended to a copy of iname as
+    an incremental update, or iname is merely copied if it already has
+    the right metadata (see add_metadata_incremental). The whole file is
+    rewritten only if this fails (encrypted or damaged PDF files, or PDF
+    files with XMP metadata, which the incremental update would leave
+    stale).
+    """
+    if (os.path.isfile(oname)
+            and os.path.getmtime(oname) >= os.path.getmtime(iname)
+            and has_metadata(oname, author, title)):
+        return
+    try:
+        add_metadata_incremental(iname, oname, author, title)
+    except ValueError:
+        add_metadata(iname, oname, author, title)
+
+
+class BackoffAdapter(HTTPAdapter):
+    """Transport adapter that honors the Backoff header of the Zotero API.
+
+    Under heavy load, the API asks clients to pause all requests for the
+    specified number of seconds. The end of the pause is shared by all
+    the threads that send requests through the adapter: each request
+    waits for it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backoff_lock = threading.Lock()
+        self.not_before = 0.0
+
+    def send(self, request, *args, **kwargs):
+        with self.backoff_lock:
+            delay = self.not_before-time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        r = super().send(request, *args, **kwargs)
+        backoff = r.headers.get('Backoff')
+        if backoff is not None:
+            with self.backoff_lock:
+                self.not_before = max(self.not_before,
+                                      time.monotonic()+float(backoff))
+        return r
+
+
+def create_session(params, proxies):
+    """Return a session for all requests to the Zotero API.
+
+    The session keeps connections alive. Requests that failed because
+    of a transient error (429 and 5xx status codes) are retried with
+    exponential backoff, honoring the Retry-After header. The Backoff
+    header is honored as well (see BackoffAdapter).
+
+    Args:
+        params: The query parameters shared by all requests.
+        proxies: A dictionnary to be used by the requests module.
+    """
+    session = requests.Session()
+    session.params = params
+    session.proxies = proxies
+    session.mount('https://',
+                  BackoffAdapter(pool_connections=4,
+                                 pool_maxsize=MAX_WORKERS,
+                                 max_retries=RETRY))
+    return session
+
+
+def load_cache(path):
+    """Return the object pickled to the cache file, None on a miss.
+
+    Unreadable cache files (e.g. truncated by an interrupted run) are
+    treated as missing.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Truncated or corrupted pickles raise all sorts of exceptions
+        return None
+
+
+def dump_cache(obj, path):
+    """Pickle obj to the cache file.
+
+    The object is first pickled to a temporary file in the same
+    directory, which then replaces the cache file: the cache file is
+    never left half-written, even if the run is interrupted or several
+    runs overlap.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def iter_all(session, url, cache_path=None):
+    """Iterate over all objects returned by a multi-object request.
+
+    The objects are retrieved page by page, following the 'next' links
+    of the responses, and each page is yielded as soon as it is
+    received. If cache_path is not None, the objects are pickled to
+    this file once all pages have been retrieved, along with the
+    version of the library (unless the library was modified in the
+    meantime). On subsequent calls, the first request is
+    conditional (If-Modified-Since-Version header): if the objects were
+    not modified since the cached version, the cached objects are
+    yielded without any further request.
+
+    Args:
+        session: The session to the Zotero API (see create_session).
+        url: The URL of the request.
+        cache_path: The path to the cache file (None if the objects
+            should not be cached).
+    """
+    cache = None
+    headers = {}
+    if cache_path is not None:
+        cache = load_cache(cache_path)
+    if cache is not None:
+        headers['If-Modified-Since-Version'] = str(cache['version'])
+
+    r = session.get(url, headers=headers)
+    if cache is not None and r.status_code == 304:
+        yield from cache['objects']
+        return
+    version = r.headers.get('Last-Modified-Version')
+    objects = []
+    while True:
+        # Every page is checked: a failed page must neither be parsed
+        # nor end up in the cache
+        r.raise_for_status()
+        if r.headers.get('Last-Modified-Version') != version:
+            # The library was modified while its pages were retrieved
+            version = None
+        new_objects = parse_json(r.content)
+        objects += new_objects
+        yield from new_objects
+        next_url = r.links.get('next', {}).get('url')
+        if not next_url:
+            break
+        r = session.get(next_url)
+
+    if cache_path is not None and version is not None:
+        dump_cache({'version': int(version), 'objects': objects},
+                   cache_path)
+
+
+def get_collections(session, user_prefix, cache_dir=None):
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, 'collections.pickle')
+    return list(iter_all(session, user_prefix+'/collections', cache_path))
+
+
+def find_collection_key(session, user_prefix, name, cache_dir,
+                        refresh=False):
+    """Return the key of the collection with the specified name.
+
+    Collection keys do not change: once resolved, they are stored in
+    the cache directory, and the key of a known collection is returned
+    without any request to the Zotero API. The keys of all collections
+    are resolved again if refresh is True (e.g. the remembered key is
+    that of a deleted collection, see iter_collection_items).
+
+    Raises:
+        RuntimeError: No collection has the specified name.
+    """
+    path = os.path.join(cache_dir, 'collection_keys.pickle')
+    keys = {} if refresh else load_cache(path) or {}
+    if name not in keys:
+        # The names of renamed or deleted collections are forgotten
+        keys = {}
+        for collection in get_collections(session, user_prefix, cache_dir):
+            data = collection['data']
+            keys.setdefault(data['name'], data['key'])
+        if name not in keys:
+            raise RuntimeError('could not find collection: '+name)
+        dump_cache(keys, path)
+    return keys[name]
+
+
+def iter_collection_items(session, user_prefix, name, key, cache_dir):
+    """Iterate over the top-level items of the specified collection.
+
+    The items are retrieved by iter_all, and cached in cache_dir. If the
+    items of the collection cannot be found (404 status code), key is
+    assumed to be the stale key of a deleted collection: the key of the
+    collection is then resolved again (see find_collection_key).
+
+    Args:
+        session: The session to the Zotero API (see create_session).
+        user_prefix: The base URL of the user's library.
+        name: The name of the collection.
+        key: The key of the collection (see find_collection_key).
+        cache_dir: The cache directory.
+    """
+    def iter_items(key):
+        url = user_prefix+'/collections/'+key+'/items/top'
+        cache_path = os.path.join(cache_dir, 'items-'+key+'.pickle')
+        return iter_all(session, url, cache_path)
+
+    items = iter_items(key)
+    try:
+        # The first page is requested by the first call to next
+        first = next(items)
+    except StopIteration:
+        return
+    except requests.HTTPError as e:
+        if e.response.status_code != 404:
+            raise
+        key = find_collection_key(session, user_prefix, name, cache_dir,
+                                  refresh=True)
+        items = iter_items(key)
+    else:
+        yield first
+    yield from items
+
+
+def get_pdf_attachments(session, user_prefix, item_key):
+    """Return the paths to the PDF files attached to the specified item.
+
+    The paths are returned as stored in the Zotero library (see
+    pyzottk.attachment.full_path).
+    """
+    r = session.get(user_prefix+'/items/'+item_key+'/children')
+    r.raise_for_status()
+    children = (child['data'] for child in parse_json(r.content))
+    return [data['path'] for data in children
+            if data['itemType'] == 'attachment'
+            and data.get('contentType', '') == 'application/pdf']
+
+
+def export_item(session, user_prefix, item, base_attachment_path, output,
+                processes, onames, lock):
+    """Export the PDF files attached to the specified item.
+
+    Rewriting PDF files is CPU-bound: each of them is submitted to the
+    specified pool of processes, and the list of the corresponding
+    futures is returned. See export_items for the other arguments.
+
+    Attachments of different items may share the same base name, and
+    therefore the same output file, which must not be written by two
+    processes at once: onames is the set of output files that were
+    already submitted, and attachments whose output file is already
+    taken are skipped. Since this function runs in several threads,
+    onames is only accessed while holding lock.
+    """
+    data = item['data']
+    title = data['title']
+    author = ', '.join(full_name(creator.get('firstName', ''),
+                                 creator.get('lastName', ''))
+                       for creator in data['creators'])
+    print('Exporting "{}" ({})'.format(title, author))
+    exports = []
+    for path in get_pdf_attachments(session, user_prefix, item['key']):
+        iname = full_path(path, base_attachment_path)
+        oname = os.path.join(output, os.path.basename(iname))
+        with lock:
+            taken = oname in onames
+            onames.add(oname)
+        if taken:
+            print('Skipping "{}": {} is already exported'.format(iname,
+                                                                 oname))
+            continue
+        exports.append(processes.submit(export_attachment, iname, oname,
+                                        author, title))
+    return exports
+
+
+def export_items(session, user_prefix, items, base_attachment_path,
+                 output):
+    """Export the PDF files attached to the specified items.
+
+    items can be any iterable (see iter_all): the attachments of each
+    item are retrieved in a pool of threads as soon as the item is
+    available, and each PDF file is rewritten in a pool of processes as
+    soon as its attachment is known. Listing the items, requesting their
+    attachments and rewriting PDF files therefore overlap.
+
+    Args:
+        session: The session to the Zotero API (see create_session).
+        user_prefix: The base URL of the user's library.
+        items: The items to export, as returned by the Zotero API.
+        base_attachment_path: The root directory of linked attachments.
+        output: The export directory.
+    """
+    onames = set()
+    lock = threading.Lock()
+    # Worker processes are started on demand, from the threads below:
+    # they must not be forked while other threads hold locks (e.g. in
+    # the middle of a request or a print call)
+    spawn = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(mp_context=spawn) as processes:
+        with concurrent.futures.ThreadPoolExecutor(MAX_WORKERS) as threads:
+            futures = [threads.submit(export_item, session, user_prefix,
+                                      item, base_attachment_path, output,
+                                      processes, onames, lock)
+                       for item in items if item['meta']['numChildren'] >= 1]
+        for future in futures:
+            for export in future.result():
+                export.result()
 
 
 if __name__ == '__main__':
     args = setup_argument_parser().parse_args()
 
     cfg = parse_config()
-    user_prefix = '/'.join([BASE_URL, 'users', cfg['credentials']['user_id']])
+    user_prefix = BASE_URL+'/users/'+cfg['credentials']['user_id']
     params = {'v': 3,
               'key': cfg['credentials']['key'],
               'format': 'json',
-              'limit': ITEMS_PER_REQUEST,
-              'start': 0}
+              'limit': ITEMS_PER_REQUEST}
     proxies = dict(cfg['proxies'])
 
-    # Find key of exported collection
-    url = '/'.join([user_prefix, 'collections'])
-    collections = get_collections(user_prefix, params, proxies)
-    collection_key = None
-    params['start'] = 0
-
-    while collection_key is None:
-        r = requests.get(url=url, params=params, proxies=proxies)
-        collections = r.json()
-        for collection in collections:
-            data = collection['data']
-            if data['name'] == args.collection:
-                collection_key = data['key']
-                break
-        params['start'] += ITEMS_PER_REQUEST
-        if len(collections) < ITEMS_PER_REQUEST:
-            break
-    if collection_key is None:
-        raise RuntimeError('could not find collection: '+args.collection)
-
+    # Responses of the Zotero API are cached per user
+    cache_dir = os.path.join(config_directory(), 'cache',
+                             cfg['credentials']['user_id'])
 
-    if args.output is None:
-        args.output = os.path.join('.', args.collection)
-        if not os.path.isdir(args.output):
-            os.mkdir(args.output)
+    with create_session(params, proxies) as session:
+        # Find key of exported collection
+        collection_key = find_collection_key(session, user_prefix,
+                                             args.collection, cache_dir)
 
-    # List items in collection
-    url = '/'.join([user_prefix, 'collections', collection_key, 'items/top'])
-    params['start'] = 0
+        if args.output is None:
+            args.output = os.path.join('.', args.collection)
+            if not os.path.isdir(args.output):
+                os.mkdir(args.output)
 
-    items = []
-    while True:
-        r = requests.get(url=url, params=params, proxies=proxies)
-        new_items = list(r.json())
-        items += new_items
-        params['start'] += ITEMS_PER_REQUEST
-        if len(new_items) < ITEMS_PER_REQUEST:
-            break
+        # List items in collection
+        items = iter_collection_items(session, user_prefix,
+                                      args.collection, collection_key,
+                                      cache_dir)
 
-    params['start'] = 0
-    for i, item in enumerate(items):
-        data = item['data']
-        title = data['title']
-        author = ', '.join(full_name(creator.get('firstName', ''),
-                                     creator.get('lastName', ''))
-                           for creator in data['creators'])
-        print('[{}/{}] Exporting "{}" ({})'.format(i+1, len(items),
-                                                   title, author))
-        if item['meta']['numChildren'] >= 1:
-            url = '/'.join([user_prefix, 'items', item['key'], 'children'])
-            children = requests.get(url=url, params=params, proxies=proxies)
-            for child in children.json():
-                data = child['data']
-                is_attachment = data['itemType'] == 'attachment'
-                is_pdf = data.get('contentType', '') == 'application/pdf'
-                if is_attachment and is_pdf:
-                    iname = full_path(data['path'],
-                                      cfg['local']['base_attachment_path'])
-                    oname = os.path.join(args.output, os.path.basename(iname))
-                    with open(iname, 'rb') as fi, open(oname, 'wb') as fo:
-                        add_metadata(fi, fo, author, title)
+        export_items(session, user_prefix, items,
+                     cfg['local']['base_attachment_path'], args.output)